@@ -1,8 +1,9 @@
 import datetime
+import functools
 import hashlib
 import hmac
+import itertools
 import json
-import re
 import subprocess
 import sys
 import time
@@ -18,10 +19,15 @@ kernel_json = json.loads((kernel_dir / "kernel.json").read_text())
 print(f'Starting kernel "{kernel_json["display_name"]}" ...')
 
 argv = list(kernel_json["argv"])
-if re.match(r"python3?(?:\.exe)?$", argv[0], re.IGNORECASE):
+if argv[0].lower().removesuffix(".exe") in ("python", "python3"):
     argv[0] = sys.executable
 
-digest_key = str(uuid.uuid4())
+# Turning this off writes an empty key to the connection file, which disables
+# authentication in the kernel: any local process or user can then connect to
+# its fixed ports and run code. Only do that on a single-user machine.
+sign_messages = True
+digest_key = str(uuid.uuid4()) if sign_messages else ""
+hmac_template = hmac.new(digest_key.encode(), digestmod=hashlib.sha256)
 Path("/tmp/kernel-1234.json").write_text(
     json.dumps(
         {
@@ -46,8 +52,6 @@ for i, arg in enumerate(argv):
 print(argv)
 p = subprocess.Popen(argv)
 
-time.sleep(1)
-
 print("Connecting to kernel ...")
 
 session_id = str(uuid.uuid4())
@@ -63,31 +67,107 @@ iopub_channel.setsockopt(zmq.SUBSCRIBE, b"")
 iopub_channel.connect("tcp://127.0.0.1:40885")
 
 
-def msg_ready():
-    return iopub_channel.poll(10, zmq.POLLIN)
+# Fields and frames that are identical for every message we send.
+header_base = {"session": session_id, "username": "", "version": "5.4"}
+empty_dict_frame = b"{}"
+
+# Message IDs only need to be unique, so use a random prefix and a counter.
+msg_id_prefix = uuid.uuid4().hex
+msg_counter = itertools.count()
+
+
+def sign(frames: list[bytes]) -> bytes:
+    mac = hmac_template.copy()
+    mac.update(b"".join(frames))
+    return mac.hexdigest().encode()
+
+
+def verify(msg_list: list[bytes], delim_idx: int) -> bool:
+    if not sign_messages:
+        return True
+    signature = sign(msg_list[delim_idx + 2 : delim_idx + 6])
+    return hmac.compare_digest(signature, msg_list[delim_idx + 1])
+
+
+@functools.lru_cache(maxsize=1)
+def date_prefix(timestamp: int) -> str:
+    return datetime.datetime.fromtimestamp(timestamp).isoformat()
+
+
+def current_date() -> str:
+    """Local ISO 8601 time, only rebuilding the date part once per second."""
+    seconds, nanos = divmod(time.time_ns(), 1_000_000_000)
+    return f"{date_prefix(seconds)}.{nanos // 1000:06d}"
 
 
 def encode_msg(message_type: str, content: dict[str, Any]):
-    msg_id = str(uuid.uuid4())
+    msg_id = f"{msg_id_prefix}-{next(msg_counter)}"
     header = {
+        **header_base,
         "msg_id": msg_id,
-        "session": session_id,
-        "username": "",
-        "date": datetime.datetime.now().isoformat(),
+        "date": current_date(),
         "msg_type": message_type,
-        "version": "5.4",
     }
     msg_list: list[bytes] = [
         json.dumps(header).encode(),
-        json.dumps(None).encode(),  # parent_header
-        json.dumps(None).encode(),  # metadata
+        empty_dict_frame,  # parent_header
+        empty_dict_frame,  # metadata
         json.dumps(content).encode(),
     ]
-    mac = hmac.new(digest_key.encode(), digestmod=hashlib.sha256)
-    for msg in msg_list:
-        mac.update(msg)
-    msg_list = [b"<IDS|MSG>", mac.hexdigest().encode()] + msg_list
-    return msg_list
+    signature = sign(msg_list) if sign_messages else b""
+    msg_list = [b"<IDS|MSG>", signature] + msg_list
+    return msg_id, msg_list
+
+
+poller = zmq.Poller()
+poller.register(iopub_channel, zmq.POLLIN)
+poller.register(shell_channel, zmq.POLLIN)
+
+
+def drain(channel: zmq.Socket):
+    """Yield every message that is already queued on a socket, without blocking."""
+    while channel.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+        yield channel.recv_multipart(zmq.NOBLOCK)
+
+
+def wait_for_ready(timeout: float = 30.0):
+    """Block until the kernel answers on both the shell and iopub channels.
+
+    A shell reply does not mean the SUB socket has connected and subscribed yet,
+    so like jupyter_client's wait_for_ready, keep re-sending kernel_info_request
+    until an iopub message caused by one of them arrives as well.
+    """
+    deadline = time.monotonic() + timeout
+    request_ids: set[str] = set()
+    shell_ready = iopub_ready = False
+    next_send = 0.0
+    while not (shell_ready and iopub_ready):
+        now = time.monotonic()
+        if p.poll() is not None:
+            sys.exit(f"Kernel exited with code {p.returncode}")
+        if now >= deadline:
+            sys.exit(f"Kernel did not respond within {timeout} seconds")
+        if now >= next_send:
+            msg_id, msg_list = encode_msg("kernel_info_request", {})
+            shell_channel.send_multipart(msg_list)
+            request_ids.add(msg_id)
+            next_send = now + 1.0
+        socks = dict(poller.poll(100))
+        if shell_channel in socks:
+            for _ in drain(shell_channel):
+                shell_ready = True
+        if iopub_channel in socks:
+            for msg_list in drain(iopub_channel):
+                idx = msg_list.index(b"<IDS|MSG>")
+                if not verify(msg_list, idx):
+                    continue
+                parent_header = json.loads(msg_list[idx + 3])
+                if parent_header.get("msg_id") in request_ids:
+                    iopub_ready = True
+
+
+print("Waiting for kernel to be ready ...")
+wait_for_ready()
 
 
 content = {
@@ -99,32 +179,49 @@ content = {
     "stop_on_error": True,
 }
 
-shell_channel.send_multipart(encode_msg("execute_request", content))
+execute_id, msg_list = encode_msg("execute_request", content)
+shell_channel.send_multipart(msg_list)
 
 
+# On a SUB socket, frame 0 is the topic and the delimiter is expected at index 1.
+# Remember its position instead of searching each time, and fall back to a
+# search only if a message is laid out differently.
+delim_idx = 1
+# Quoted, so that a msg_id ending in "-1" does not match one ending in "-10".
+# Matching the raw parent_header frame avoids a JSON decode per message.
+execute_parent = f'"{execute_id}"'.encode()
 state = "busy"
 while state != "idle":
-    if not msg_ready():
+    socks = dict(poller.poll(100))
+    if shell_channel in socks:
+        for _ in drain(shell_channel):
+            pass  # execute_reply; output and status are reported on iopub
+    if iopub_channel not in socks:
         continue
-    msg_list = iopub_channel.recv_multipart()
-    delim_idx = msg_list.index(b"<IDS|MSG>")
-    header, parent_header, metadata, content = [
-        json.loads(buf) for buf in msg_list[delim_idx + 2 :]
-    ]
-    match header["msg_type"]:
-        case "status":
-            state = content["execution_state"]
-            print(f"Kernel state: {state}")
-        case "stream":
-            print(content["text"])
-        case "execute_input":
-            print("INFO: Kernel is executing", content["code"])
-        case "execute_result":
-            print(content["data"]["text/plain"])
-        case "error":
-            print("ERROR:", content["traceback"])
-        case _:
-            print(f"Unknown message type: {header['msg_type']}")
+    for msg_list in drain(iopub_channel):
+        if msg_list[delim_idx] != b"<IDS|MSG>":
+            delim_idx = msg_list.index(b"<IDS|MSG>")
+        if not verify(msg_list, delim_idx):
+            print("WARNING: Dropping message with invalid signature")
+            continue
+        if execute_parent not in msg_list[delim_idx + 3]:
+            continue  # e.g., status updates for the kernel_info_requests
+        header = json.loads(msg_list[delim_idx + 2])
+        content = json.loads(msg_list[delim_idx + 5])  # metadata is unused
+        match header["msg_type"]:
+            case "status":
+                state = content["execution_state"]
+                print(f"Kernel state: {state}")
+            case "stream":
+                print(content["text"])
+            case "execute_input":
+                print("INFO: Kernel is executing", content["code"])
+            case "execute_result":
+                print(content["data"]["text/plain"])
+            case "error":
+                print("ERROR:", content["traceback"])
+            case _:
+                print(f"Unknown message type: {header['msg_type']}")
 
 
 print("Terminating kernel ...")